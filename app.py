@@ -1,17 +1,20 @@
 import streamlit as st
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 from docx import Document
 from docx.shared import Pt, Inches, Cm
 from docx.enum.text import WD_ALIGN_PARAGRAPH
 from docx.enum.section import WD_ORIENT, WD_SECTION
 from docx.oxml.ns import qn
 from docx.oxml import OxmlElement
-import tempfile
-import os
-import json
+import orjson
 import pandas as pd
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import io
+import copy
+import hashlib
+import re
 
 # --- CONFIGURE PAGE ---
 st.set_page_config(page_title="NAU Tour Diary Generator", layout="wide")
@@ -30,6 +33,173 @@ with st.sidebar:
     GEMINI_API_KEY = st.text_input("Gemini API Key", type="password")
     st.info("Get your key from Google AI Studio.")
 
+# --- GEMINI SETUP ---
+
+_PROMPT = """
+Analyze this document. Identify if it is a 'Tour Approval', 'Salary Slip', or 'Map Screenshot'.
+
+1. If **Tour Approval** (looks like "Online Tour Management System"):
+   - Extract 'type': 'tour_approval'.
+   - Extract 'system_no': The long number usually below a barcode or labeled "Tour ID/System No" (e.g., 21781756377236).
+   - Extract 'user_details': { 'name', 'designation', 'budget_head' (B.H.) } if visible.
+   - Extract 'trips': A list of journeys. For each:
+     - departure_date (DD/MM/YYYY)
+     - departure_time (HH:MM)
+     - departure_place (City/Campus)
+     - arrival_date (DD/MM/YYYY)
+     - arrival_time (HH:MM)
+     - arrival_place
+     - mode_of_journey
+     - purpose (Extract the specific reason/course name).
+
+2. If **Map Screenshot** (Google Maps):
+   - Extract 'type': 'map_data'.
+   - Extract 'distance_km': Numeric value of total distance (e.g., 142).
+   - Extract 'travel_time': Time string (e.g., "3 hr 15 min").
+   - Extract 'locations': Start and End points if visible.
+
+3. If **Salary Slip**:
+   - Extract 'type': 'salary'.
+   - Extract 'basic_pay'.
+"""
+
+# Single flat schema covering all three document types; fields not relevant
+# to the detected 'type' are simply omitted by the model.
+_STRING = {"type": "STRING"}
+_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "type": {"type": "STRING", "enum": ["tour_approval", "map_data", "salary"]},
+        "system_no": _STRING,
+        "user_details": {
+            "type": "OBJECT",
+            "properties": {"name": _STRING, "designation": _STRING, "budget_head": _STRING},
+        },
+        "trips": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "departure_date": _STRING,
+                    "departure_time": _STRING,
+                    "departure_place": _STRING,
+                    "arrival_date": _STRING,
+                    "arrival_time": _STRING,
+                    "arrival_place": _STRING,
+                    "mode_of_journey": _STRING,
+                    "purpose": _STRING,
+                },
+            },
+        },
+        "distance_km": {"type": "NUMBER"},
+        "travel_time": _STRING,
+        "locations": {
+            "type": "OBJECT",
+            "properties": {"start": _STRING, "end": _STRING},
+        },
+        "basic_pay": _STRING,
+    },
+    "required": ["type"],
+}
+
+_GENERATION_CONFIG = genai.types.GenerationConfig(
+    response_mime_type="application/json", response_schema=_SCHEMA
+)
+
+_BATCH_PROMPT = _PROMPT + """
+This request contains several documents. Return an object with a 'documents' list
+holding one entry per document. Set 'source_index' on each entry to the 0-based
+position of the document it describes, in the order the documents were given.
+"""
+
+_BATCH_GENERATION_CONFIG = genai.types.GenerationConfig(
+    response_mime_type="application/json",
+    response_schema={
+        "type": "OBJECT",
+        "properties": {
+            "documents": {
+                "type": "ARRAY",
+                "items": {
+                    **_SCHEMA,
+                    "properties": {**_SCHEMA["properties"], "source_index": {"type": "INTEGER"}},
+                    "required": ["type", "source_index"],
+                },
+            },
+        },
+        "required": ["documents"],
+    },
+)
+
+# Gemini rejects inline request payloads above ~20 MB; larger PDFs use the File API.
+_INLINE_LIMIT = 20 * 1024 * 1024
+
+# Small uploads are sent to Gemini in one combined request.
+_BATCH_MAX_FILES = 8
+_BATCH_MAX_BYTES = 18 * 1024 * 1024
+
+# Upper bound on Gemini requests in flight at once, to stay polite to rate limits.
+_MAX_CONCURRENT_REQUESTS = 8
+
+_MODEL_NAME = 'gemini-3-flash-preview'
+
+# st.cache_data keys only on a function's own source, so anything that changes
+# the shape of an extraction is hashed here and passed to the cached extractors;
+# editing the prompt, schema or model then invalidates the on-disk cache.
+_EXTRACT_VERSION = hashlib.sha256(
+    repr((_MODEL_NAME, _BATCH_PROMPT, _GENERATION_CONFIG, _BATCH_GENERATION_CONFIG)).encode()
+).hexdigest()
+
+# Longest single wait between retries, so a long quota delay cannot stall the script
+_MAX_RETRY_WAIT = 60
+
+_backoff = wait_exponential(multiplier=1, min=1, max=_MAX_RETRY_WAIT)
+
+def _retry_wait(retry_state):
+    """
+    Sleeps for the server's RetryInfo delay when given, else backs off exponentially;
+    either way the wait is capped at _MAX_RETRY_WAIT seconds.
+    """
+    exc = retry_state.outcome.exception()
+    for detail in getattr(exc, 'details', None) or []:
+        delay = getattr(detail, 'retry_delay', None)
+        if delay is None:
+            continue
+        if hasattr(delay, 'total_seconds'):
+            return min(delay.total_seconds(), _MAX_RETRY_WAIT)
+        return min(delay.seconds + delay.nanos / 1e9, _MAX_RETRY_WAIT)
+    return _backoff(retry_state)
+
+# TooManyRequests is the base of ResourceExhausted (gRPC) and is what a 429 over
+# the REST transport maps to.
+@retry(
+    retry=retry_if_exception_type(
+        (google_exceptions.TooManyRequests, google_exceptions.ServiceUnavailable)
+    ),
+    wait=_retry_wait,
+    stop=stop_after_attempt(6),
+    reraise=True,
+)
+def _generate(model, parts, generation_config):
+    """generate_content with retries on 429 (rate limit) and 503 responses."""
+    return model.generate_content(
+        parts, generation_config=generation_config, request_options={"timeout": 120}
+    )
+
+# --- DOCX FORMATTING CONSTANTS ---
+
+_PT10, _PT11, _PT12, _PT14, _PT24 = Pt(10), Pt(11), Pt(12), Pt(14), Pt(24)
+_HALF_IN = Inches(0.5)
+_CENTER = WD_ALIGN_PARAGRAPH.CENTER
+_LEFT = WD_ALIGN_PARAGRAPH.LEFT
+_RIGHT = WD_ALIGN_PARAGRAPH.RIGHT
+
+# Trip table column widths (Place, Date, Time x2, Mode, KM, Purpose); sums to the
+# 10" of usable landscape width
+_COL_WIDTHS = [Cm(w) for w in (3.2, 2.3, 1.6, 3.2, 2.3, 1.6, 2.6, 1.4, 7.2)]
+
+# Date format Gemini is asked to use for departure/arrival dates
+_DMY = "%d/%m/%Y"
+
 # --- HELPER FUNCTIONS ---
 
 def set_landscape(doc):
@@ -40,69 +210,153 @@ def set_landscape(doc):
     section.page_width = new_width
     section.page_height = new_height
     # Adjust margins for landscape
-    section.left_margin = Inches(0.5)
-    section.right_margin = Inches(0.5)
-    section.top_margin = Inches(0.5)
-    section.bottom_margin = Inches(0.5)
+    section.left_margin = _HALF_IN
+    section.right_margin = _HALF_IN
+    section.top_margin = _HALF_IN
+    section.bottom_margin = _HALF_IN
 
-def extract_doc_data(uploaded_file, api_key):
+@st.cache_data(show_spinner=False, persist="disk")
+def extract_doc_data(file_bytes, extract_version, _file_name):
     """
     Uses Gemini to extract data from Tour Orders, Tickets, Salary Slips, or Map Screenshots.
+    Raises on failure. The SDK must already be configured with the caller's API key.
+    Results are cached on disk by file content, so reruns skip the Gemini round-trip;
+    the file name is left out of the cache key, so renaming a file does not
+    invalidate it, while a new extract_version does.
     """
-    genai.configure(api_key=api_key)
+    model = genai.GenerativeModel(_MODEL_NAME)
+    if len(file_bytes) <= _INLINE_LIMIT:
+        # Small PDFs go inline with the prompt: one round-trip instead of two.
+        pdf_part = {"mime_type": "application/pdf", "data": file_bytes}
+    else:
+        pdf_part = genai.upload_file(
+            path=io.BytesIO(file_bytes), mime_type="application/pdf", display_name=_file_name
+        )
     
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
-        tmp.write(uploaded_file.getvalue())
-        tmp_path = tmp.name
+    response = _generate(model, [pdf_part, _PROMPT], _GENERATION_CONFIG)
+    return orjson.loads(response.text)
 
+@st.cache_data(show_spinner=False, persist="disk")
+def extract_batch_data(files_bytes, extract_version):
+    """
+    Extracts several small PDFs with a single Gemini call.
+    Returns one dict per input file, in order; raises on failure or if any file
+    is missing from or duplicated in the reply.
+    """
+    model = genai.GenerativeModel(_MODEL_NAME)
+    parts = [{"mime_type": "application/pdf", "data": b} for b in files_bytes]
+    response = _generate(model, parts + [_BATCH_PROMPT], _BATCH_GENERATION_CONFIG)
+    documents = orjson.loads(response.text)["documents"]
+    by_index = {doc.pop("source_index"): doc for doc in documents}
+    if len(documents) != len(files_bytes) or sorted(by_index) != list(range(len(files_bytes))):
+        raise ValueError(f"Expected documents 0..{len(files_bytes) - 1}, got {sorted(by_index)}")
+    return [by_index[i] for i in range(len(files_bytes))]
+
+def _extract_batch(uploads):
+    """
+    Takes (file name, bytes) pairs and returns (file name, data, None) results
+    from one batched call, or None when the upload is too large to batch or the
+    batched call fails. When the call is still rate-limited after its retries,
+    every file gets the error instead: per-file calls would hit the same limit.
+    """
+    files_bytes = tuple(b for _, b in uploads)
+    if len(files_bytes) > _BATCH_MAX_FILES or sum(map(len, files_bytes)) > _BATCH_MAX_BYTES:
+        return None
     try:
-        sample_file = genai.upload_file(path=tmp_path, display_name="NAU_Doc")
-        
-        model = genai.GenerativeModel('gemini-3-flash-preview') # Updated to stable model name if needed, or keep 'gemini-3-flash-preview'
-        
-        prompt = """
-        Analyze this document. Identify if it is a 'Tour Approval', 'Salary Slip', or 'Map Screenshot'.
-        
-        1. If **Tour Approval** (looks like "Online Tour Management System"):
-           - Extract 'type': 'tour_approval'.
-           - Extract 'system_no': The long number usually below a barcode or labeled "Tour ID/System No" (e.g., 21781756377236).
-           - Extract 'user_details': { 'name', 'designation', 'budget_head' (B.H.) } if visible.
-           - Extract 'trips': A list of journeys. For each:
-             - departure_date (DD/MM/YYYY)
-             - departure_time (HH:MM)
-             - departure_place (City/Campus)
-             - arrival_date (DD/MM/YYYY)
-             - arrival_time (HH:MM)
-             - arrival_place
-             - mode_of_journey
-             - purpose (Extract the specific reason/course name).
-        
-        2. If **Map Screenshot** (Google Maps):
-           - Extract 'type': 'map_data'.
-           - Extract 'distance_km': Numeric value of total distance (e.g., 142).
-           - Extract 'travel_time': Time string (e.g., "3 hr 15 min").
-           - Extract 'locations': Start and End points if visible.
-        
-        3. If **Salary Slip**:
-           - Extract 'type': 'salary'.
-           - Extract 'basic_pay'.
-        
-        Return ONLY valid JSON.
-        """
-        
-        response = model.generate_content([sample_file, prompt])
-        text = response.text.strip()
-        if text.startswith('```json'):
-            text = text.replace('```json', '').replace('```', '')
-        return json.loads(text)
-        
-    except Exception as e:
-        st.error(f"Error processing {uploaded_file.name}: {str(e)}")
+        documents = extract_batch_data(files_bytes, _EXTRACT_VERSION)
+    except google_exceptions.TooManyRequests as e:
+        return [(name, None, str(e)) for name, _ in uploads]
+    except Exception:
         return None
-    finally:
-        os.remove(tmp_path)
+    return [(name, data, None) for (name, _), data in zip(uploads, documents)]
 
-def generate_word_doc(tour_data, user_details):
+def _process(upload):
+    """
+    Worker for the extraction pool. Takes a (file name, bytes) pair and returns
+    (file name, data, error message). Streamlit calls are not made here since
+    workers run outside the script thread.
+    """
+    file_name, file_bytes = upload
+    try:
+        return file_name, extract_doc_data(file_bytes, _EXTRACT_VERSION, file_name), None
+    except Exception as e:
+        return file_name, None, str(e)
+
+def _make_row_template(table):
+    """
+    Builds an empty data row (<w:tr>) matching the table grid, with 10pt runs
+    centered in every column except the last (Purpose), which is left-aligned.
+    """
+    tr = OxmlElement('w:tr')
+    grid_cols = table._tbl.tblGrid.gridCol_lst
+    for i, grid_col in enumerate(grid_cols):
+        tc = OxmlElement('w:tc')
+        tc_pr = OxmlElement('w:tcPr')
+        tc_pr.append(OxmlElement('w:tcW', {qn('w:w'): grid_col.get(qn('w:w')), qn('w:type'): 'dxa'}))
+        tc.append(tc_pr)
+
+        p = OxmlElement('w:p')
+        p_pr = OxmlElement('w:pPr')
+        p_pr.append(OxmlElement('w:jc', {qn('w:val'): 'left' if i == len(grid_cols) - 1 else 'center'}))
+        p.append(p_pr)
+
+        r = OxmlElement('w:r')
+        r_pr = OxmlElement('w:rPr')
+        r_pr.append(OxmlElement('w:sz', {qn('w:val'): '20'}))  # half-points: 10pt
+        r.append(r_pr)
+        p.append(r)
+        tc.append(p)
+        tr.append(tc)
+    return tr
+
+def _set_run_text(r, text):
+    """
+    Writes text into a <w:r> the way python-docx's Run.text does: tabs become
+    <w:tab/>, newlines and carriage returns become <w:br/>.
+    """
+    for part in re.split(r'([\t\r\n])', text):
+        if part == '\t':
+            r.append(OxmlElement('w:tab'))
+        elif part in ('\r', '\n'):
+            r.append(OxmlElement('w:br'))
+        elif part:
+            t = OxmlElement('w:t', {qn('xml:space'): 'preserve'})
+            t.text = part
+            r.append(t)
+
+def _make_row_xml(row_template, trip):
+    """Returns a filled copy of the data-row template for one trip."""
+    # --- UPDATED PURPOSE TEXT ---
+    sys_no = trip.get('system_no', '')
+    purpose_desc = trip.get('purpose', '')
+    purpose_text = (
+        f"Subject of Tour: {purpose_desc}\n"
+        f"This tour was approved by the Principal, NMCA, NAU, Navsari in Online Tour management System No. {sys_no}"
+    )
+    values = [
+        str(trip.get('departure_place', 'NAU, Navsari')),
+        str(trip.get('departure_date', '')),
+        str(trip.get('departure_time', '')),
+        str(trip.get('arrival_place', '')),
+        str(trip.get('arrival_date', '')),
+        str(trip.get('arrival_time', '')),
+        str(trip.get('mode_of_journey', 'Private Vehicle')),
+        str(trip.get('distance_km', '')),
+        purpose_text,
+    ]
+
+    tr = copy.deepcopy(row_template)
+    for tc, value in zip(tr.findall(qn('w:tc')), values):
+        _set_run_text(tc.find(qn('w:p')).find(qn('w:r')), value)
+    return tr
+
+@st.cache_resource(show_spinner=False)
+def _diary_template_bytes():
+    """
+    Builds the parts of the diary that never change (page setup, title, header
+    table layout, trip table headings, certificate and signatures) once and
+    returns them as .docx bytes for generate_word_doc to fill in.
+    """
     doc = Document()
     set_landscape(doc)
     
@@ -110,134 +364,69 @@ def generate_word_doc(tour_data, user_details):
     style = doc.styles['Normal']
     font = style.font
     font.name = 'Times New Roman'
-    font.size = Pt(11)
+    font.size = _PT11
 
     # --- HEADER ---
     # Title
     p_title = doc.add_paragraph()
-    p_title.alignment = WD_ALIGN_PARAGRAPH.CENTER
+    p_title.alignment = _CENTER
     run_title = p_title.add_run("TOUR DIARY")
     run_title.bold = True
-    run_title.font.size = Pt(14)
+    run_title.font.size = _PT14
     run_title.font.underline = True
     
-    # Determine Month Range
-    dates = [t['departure_date'] for t in tour_data if t.get('departure_date')]
-    month_str = ""
-    if dates:
-        try:
-            date_objs = [datetime.strptime(d, "%d/%m/%Y") for d in dates]
-            min_date = min(date_objs)
-            max_date = max(date_objs)
-            if min_date.month == max_date.month and min_date.year == max_date.year:
-                month_str = f"Month: {min_date.strftime('%B-%Y')}"
-            else:
-                month_str = f"Month: {min_date.strftime('%B-%Y')} to {max_date.strftime('%B-%Y')}"
-        except:
-            pass
-
     # --- UPDATED HEADER LAYOUT (Table: 2 Rows, 3 Cols) ---
+    # Cells are left empty here; generate_word_doc adds the text runs.
     header_table = doc.add_table(rows=2, cols=3)
     header_table.autofit = True
-    
-    # Row 1: Name (Left), Designation (Center), Department (Right)
-    r1 = header_table.rows[0].cells
-    
-    # Left: Name
-    r1[0].text = f"Name: {user_details.get('name', 'Vaibhav Kumar Kanubhai Chaudhari')}"
-    r1[0].paragraphs[0].alignment = WD_ALIGN_PARAGRAPH.LEFT
-    
-    # Center: Designation
-    r1[1].text = f"Designation: {user_details.get('designation', 'Associate Professor')}"
-    r1[1].paragraphs[0].alignment = WD_ALIGN_PARAGRAPH.CENTER
-    
-    # Right: Dept
-    r1[2].text = "Dept. of Entomology, N.M.C.A., N.A.U., Navsari"
-    r1[2].paragraphs[0].alignment = WD_ALIGN_PARAGRAPH.RIGHT
-
-    # Row 2: Basic Pay (Left), B.H. (Center), Month (Right)
-    r2 = header_table.rows[1].cells
-    
-    # Left: Basic Pay
-    r2[0].text = f"Basic Salary: {user_details.get('basic_pay', 'N/A')}"
-    r2[0].paragraphs[0].alignment = WD_ALIGN_PARAGRAPH.LEFT
-    
-    # Center: B.H.
-    r2[1].text = f"B.H: {user_details.get('budget_head', '303/2092')}"
-    r2[1].paragraphs[0].alignment = WD_ALIGN_PARAGRAPH.CENTER
-    
-    # Right: Month
-    r2[2].text = month_str
-    r2[2].paragraphs[0].alignment = WD_ALIGN_PARAGRAPH.RIGHT
+    for row in header_table.rows:
+        for cell, align in zip(row.cells, (_LEFT, _CENTER, _RIGHT)):
+            cell.paragraphs[0].alignment = align
+    header_table.cell(0, 2).paragraphs[0].add_run("Dept. of Entomology, N.M.C.A., N.A.U., Navsari")
 
-    doc.add_paragraph().paragraph_format.space_after = Pt(12)
+    doc.add_paragraph().paragraph_format.space_after = _PT12
 
     # --- TABLE ---
     # Columns: Dep (Place, Date, Time), Arr (Place, Date, Time), Mode, KM, Purpose
     table = doc.add_table(rows=2, cols=9)
     table.style = 'Table Grid'
+    table.autofit = False  # fixed layout: Word uses the widths below as-is
+    for column, width in zip(table.columns, _COL_WIDTHS):
+        column.width = width
+        for cell in column.cells:
+            cell.width = width
     
     # Header Rows
     row0 = table.rows[0].cells
     row0[0].merge(row0[2]) # Merge first 3 for Departure
     row0[0].text = "Departure"
-    row0[0].paragraphs[0].alignment = WD_ALIGN_PARAGRAPH.CENTER
+    row0[0].paragraphs[0].alignment = _CENTER
     
     row0[3].merge(row0[5]) # Merge next 3 for Arrival
     row0[3].text = "Arrival"
-    row0[3].paragraphs[0].alignment = WD_ALIGN_PARAGRAPH.CENTER
+    row0[3].paragraphs[0].alignment = _CENTER
     
     # Row 1 Subheaders
     hdr_cells = table.rows[1].cells
     sub_headers = ["Place", "Date", "Time", "Place", "Date", "Time", "Mode", "KM", "Purpose of Journey"]
     for i, txt in enumerate(sub_headers):
-        hdr_cells[i].text = txt
-        run = hdr_cells[i].paragraphs[0].runs[0]
+        run = hdr_cells[i].paragraphs[0].add_run(txt)
         run.bold = True
-        run.font.size = Pt(10)
-
-    # Fill Data
-    for trip in tour_data:
-        row_cells = table.add_row().cells
-        
-        row_cells[0].text = str(trip.get('departure_place', 'NAU, Navsari'))
-        row_cells[1].text = str(trip.get('departure_date', ''))
-        row_cells[2].text = str(trip.get('departure_time', ''))
-        row_cells[3].text = str(trip.get('arrival_place', ''))
-        row_cells[4].text = str(trip.get('arrival_date', ''))
-        row_cells[5].text = str(trip.get('arrival_time', ''))
-        row_cells[6].text = str(trip.get('mode_of_journey', 'Private Vehicle'))
-        row_cells[7].text = str(trip.get('distance_km', ''))
-        
-        # --- UPDATED PURPOSE TEXT ---
-        sys_no = trip.get('system_no', '')
-        purpose_desc = trip.get('purpose', '')
-        purpose_text = (
-            f"Subject of Tour: {purpose_desc}\n"
-            f"This tour was approved by the Principal, NMCA, NAU, Navsari in Online Tour management System No. {sys_no}"
-        )
-        row_cells[8].text = purpose_text
-        
-        # Formatting cells
-        for cell in row_cells:
-            for p in cell.paragraphs:
-                p.alignment = WD_ALIGN_PARAGRAPH.CENTER if cell != row_cells[8] else WD_ALIGN_PARAGRAPH.LEFT
-                for r in p.runs:
-                    r.font.size = Pt(10)
+        run.font.size = _PT10
 
-    doc.add_paragraph().paragraph_format.space_after = Pt(24)
+    doc.add_paragraph().paragraph_format.space_after = _PT24
 
     # --- CERTIFICATE SECTION (ADDED AS REQUESTED) ---
     p_cert_title = doc.add_paragraph()
-    p_cert_title.alignment = WD_ALIGN_PARAGRAPH.CENTER
+    p_cert_title.alignment = _CENTER
     run_cert = p_cert_title.add_run("Certificate")
     run_cert.bold = True
-    run_cert.font.size = Pt(11) # Matching doc font size
+    run_cert.font.size = _PT11 # Matching doc font size
 
     p_cert_text = doc.add_paragraph("This is to certify that above said TA bill is preapred based on actual journey and actual destination with shortest routes")
-    p_cert_text.alignment = WD_ALIGN_PARAGRAPH.CENTER
+    p_cert_text.alignment = _CENTER
     
-    doc.add_paragraph().paragraph_format.space_after = Pt(12)
+    doc.add_paragraph().paragraph_format.space_after = _PT12
 
     # --- UPDATED SIGNATURE BLOCK (Table: 1 Row, 3 Cols) ---
     # Left: User | Center: Recommended | Right: Approved
@@ -247,7 +436,7 @@ def generate_word_doc(tour_data, user_details):
     # COL 1: User (Left Aligned)
     cell_user = sig_table.cell(0, 0)
     p_user = cell_user.paragraphs[0]
-    p_user.alignment = WD_ALIGN_PARAGRAPH.LEFT
+    p_user.alignment = _LEFT
     run_u = p_user.add_run(
         "(V. K. Chaudhari)\n"
         "Senior Acarologist\n"
@@ -260,7 +449,7 @@ def generate_word_doc(tour_data, user_details):
     # COL 2: Recommended (Center Aligned)
     cell_rec = sig_table.cell(0, 1)
     p_rec = cell_rec.paragraphs[0]
-    p_rec.alignment = WD_ALIGN_PARAGRAPH.CENTER
+    p_rec.alignment = _CENTER
     run_r = p_rec.add_run(
         "Recommended\n\n\n"
         "Professor and Head\n"
@@ -273,7 +462,7 @@ def generate_word_doc(tour_data, user_details):
     # COL 3: Approved (Right Aligned)
     cell_app = sig_table.cell(0, 2)
     p_app = cell_app.paragraphs[0]
-    p_app.alignment = WD_ALIGN_PARAGRAPH.RIGHT
+    p_app.alignment = _RIGHT
     run_a = p_app.add_run(
         "Approved\n\n\n"
         "Principal and Dean\n"
@@ -282,6 +471,48 @@ def generate_word_doc(tour_data, user_details):
     )
     run_a.bold = True
 
+    bio = io.BytesIO()
+    doc.save(bio)
+    return bio.getvalue()
+
+def generate_word_doc(tour_data, user_details, dep_dates=None):
+    """
+    Builds the landscape tour diary. dep_dates may carry the already-parsed
+    departure dates (aligned with tour_data) so they are not parsed again.
+    """
+    doc = Document(io.BytesIO(_diary_template_bytes()))
+    header_table, table = doc.tables[0], doc.tables[1]
+    
+    # Determine Month Range
+    if dep_dates is None:
+        dep_dates = pd.to_datetime(
+            [t.get('departure_date') for t in tour_data], format=_DMY, errors='coerce'
+        )
+    month_str = ""
+    min_date, max_date = dep_dates.min(), dep_dates.max()  # NaT entries are skipped
+    if not pd.isna(min_date):
+        if min_date.month == max_date.month and min_date.year == max_date.year:
+            month_str = f"Month: {min_date.strftime('%B-%Y')}"
+        else:
+            month_str = f"Month: {min_date.strftime('%B-%Y')} to {max_date.strftime('%B-%Y')}"
+
+    # --- HEADER VALUES ---
+    # Row 1: Name (Left), Designation (Center); Department (Right) is in the template
+    r1 = header_table.rows[0].cells
+    r1[0].paragraphs[0].add_run(f"Name: {user_details.get('name', 'Vaibhav Kumar Kanubhai Chaudhari')}")
+    r1[1].paragraphs[0].add_run(f"Designation: {user_details.get('designation', 'Associate Professor')}")
+
+    # Row 2: Basic Pay (Left), B.H. (Center), Month (Right)
+    r2 = header_table.rows[1].cells
+    r2[0].paragraphs[0].add_run(f"Basic Salary: {user_details.get('basic_pay', 'N/A')}")
+    r2[1].paragraphs[0].add_run(f"B.H: {user_details.get('budget_head', '303/2092')}")
+    r2[2].paragraphs[0].add_run(month_str)
+
+    # Fill Data (rows are cloned from a pre-styled XML template and appended
+    # in one go, bypassing python-docx's per-row/per-cell round-trips)
+    row_template = _make_row_template(table)
+    table._tbl.extend([_make_row_xml(row_template, trip) for trip in tour_data])
+
     return doc
 
 # --- MAIN APP LOGIC ---
@@ -298,12 +529,63 @@ if uploaded_files and st.button("Generate Word Diary"):
         with st.spinner("Analyzing documents & Smart Merging..."):
             
             tour_entries = []
+            trip_approvals = []  # index of the tour approval each trip came from
+            approval_count = 0
             map_entries = []
             user_info = {}
             
-            # 1. Extract Data
-            for file in uploaded_files:
-                data = extract_doc_data(file, GEMINI_API_KEY)
+            # 1. Extract Data (one batched call for small uploads,
+            #    otherwise I/O-bound per-file Gemini calls run concurrently).
+            #    Identical files are sent once, and files already extracted
+            #    earlier in this session are not sent at all.
+            #    Each upload's bytes are read once and shared by every step below.
+            uploads = [(f.name, f.getvalue()) for f in uploaded_files]
+            digests = [hashlib.sha256(b).hexdigest() for _, b in uploads]
+            unique_uploads = {}
+            for upload, h in zip(uploads, digests):
+                unique_uploads.setdefault(h, upload)
+
+            if 'extract_cache' not in st.session_state:
+                st.session_state.extract_cache = {}
+            extract_cache = st.session_state.extract_cache
+            pending = [(h, u) for h, u in unique_uploads.items() if h not in extract_cache]
+            errors = {}
+
+            if pending:
+                pending_uploads = [u for _, u in pending]
+                # Configured on the script thread every run: the SDK keeps the key
+                # in global state, which other sessions may have changed since.
+                genai.configure(api_key=GEMINI_API_KEY)
+                pending_results = None
+                if len(pending_uploads) > 1:
+                    pending_results = _extract_batch(pending_uploads)
+                if pending_results is None:
+                    pending_results = [None] * len(pending_uploads)
+                    progress = st.progress(0.0, text="Extracting documents...")
+                    with ThreadPoolExecutor(max_workers=min(_MAX_CONCURRENT_REQUESTS, len(pending_uploads))) as ex:
+                        futures = {
+                            ex.submit(_process, u): i
+                            for i, u in enumerate(pending_uploads)
+                        }
+                        for done, future in enumerate(as_completed(futures), start=1):
+                            pending_results[futures[future]] = future.result()
+                            progress.progress(
+                                done / len(pending_uploads),
+                                text=f"Extracted {done}/{len(pending_uploads)} documents",
+                            )
+                    progress.empty()
+
+                for (h, _), (_, data, error) in zip(pending, pending_results):
+                    if data:
+                        extract_cache[h] = data
+                    else:
+                        errors[h] = error
+
+            results = [(name, extract_cache.get(h), errors.get(h)) for (name, _), h in zip(uploads, digests)]
+
+            for file_name, data, error in results:
+                if error:
+                    st.error(f"Error processing {file_name}: {error}")
                 if data:
                     dtype = data.get('type')
                     if dtype == 'salary':
@@ -316,41 +598,57 @@ if uploaded_files and st.button("Generate Word Diary"):
                             if u.get('designation'): user_info['designation'] = u['designation']
                             if u.get('budget_head'): user_info['budget_head'] = u['budget_head']
                         
+                        approval_no = approval_count
+                        approval_count += 1
                         trips = data.get('trips', [])
                         if isinstance(trips, list):
                             for t in trips:
                                 t['system_no'] = data.get('system_no', 'Unknown')
                                 tour_entries.append(t)
+                                trip_approvals.append(approval_no)
                         elif isinstance(trips, dict):
                              trips['system_no'] = data.get('system_no', 'Unknown')
                              tour_entries.append(trips)
+                             trip_approvals.append(approval_no)
                              
                     elif dtype == 'map_data':
                         map_entries.append(data)
 
-            # 2. Smart Merge
-            for i, tour in enumerate(tour_entries):
-                curr_dist = str(tour.get('distance_km', '0')).strip()
-                if curr_dist in ['0', '', 'None'] and map_entries:
-                    m_data = map_entries[0] 
-                    tour['distance_km'] = m_data.get('distance_km', '0')
+            # 2. Smart Merge: a trip without its own distance takes the distance
+            #    from the map screenshot paired with its tour approval (k-th map
+            #    for the k-th approval, in upload order); trips whose approval
+            #    has no map of its own fall back to the first map
+            # 3. Sort by Date (missing/unparsable dates first)
+            if tour_entries:
+                tour_df = pd.DataFrame({
+                    'distance_km': [t.get('distance_km', '0') for t in tour_entries],
+                    'departure_date': [t.get('departure_date') for t in tour_entries],
+                })
+                missing = tour_df['distance_km'].fillna('').astype(str).str.strip().isin(['0', '', 'None'])
+                if map_entries:
+                    map_dist = [m.get('distance_km', '0') for m in map_entries]
+                    for i in tour_df.index[missing]:
+                        k = trip_approvals[i]
+                        dist = map_dist[k] if k < len(map_dist) else map_dist[0]
+                        tour_entries[i] = {**tour_entries[i], 'distance_km': dist}
 
-            # 3. Sort by Date
-            try:
-                tour_entries.sort(key=lambda x: datetime.strptime(x['departure_date'], "%d/%m/%Y") if x.get('departure_date') else datetime.min)
-            except:
-                pass
+                dep_dates = pd.to_datetime(
+                    tour_df['departure_date'], format=_DMY, errors='coerce'
+                )
+                dep_dates = dep_dates.sort_values(na_position='first', kind='stable')
+                tour_entries = [tour_entries[i] for i in dep_dates.index]
 
             if tour_entries:
-                doc = generate_word_doc(tour_entries, user_info)
+                doc = generate_word_doc(tour_entries, user_info, dep_dates)
                 
                 bio = io.BytesIO()
                 doc.save(bio)
+                bio.seek(0)
                 
                 st.success("Diary Generated Successfully!")
                 st.download_button(
                     label="Download Tour Diary (.docx)",
-                    data=bio.getvalue(),
+                    data=bio,
                     file_name="NAU_Tour_Diary_Landscape.docx",
                     mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
                 )